@@ -0,0 +1,505 @@
+"""Record gateway dispatch events from the live bot and replay them offline.
+
+Recording is switched on in main.py by setting RECORD_EVENTS_PATH; every
+dispatch the bot's handlers care about is sanitized and appended to a gzipped
+JSON-lines file. Replaying loads main.py against a fake Supabase and a fake
+HTTP client, feeds the recorded payloads through discord.py's own parsers at
+the requested speed, and prints handler throughput, queueing delay and the
+outbound API calls the bot tried to make.
+
+    python loadtest.py events.jsonl.gz --speed 20
+
+Without the members intent the gateway never sends GUILD_MEMBER_ADD, so a
+default-intents recording has no joins in it. Use --synthetic-joins to inject
+a join wave into the first recorded guild when validating the raid defence.
+"""
+import os
+import sys
+import json
+import gzip
+import time
+import zlib
+import queue
+import threading
+import asyncio
+import hashlib
+import argparse
+import importlib
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+FORMAT_NAME = "nene-gateway"
+FORMAT_VERSION = 1
+
+RECORDED_EVENTS = {"GUILD_CREATE", "MESSAGE_CREATE", "GUILD_MEMBER_ADD", "GUILD_MEMBER_REMOVE"}
+COMMAND_PREFIX = "KN-"
+BOT_USER_ID = 1 << 55
+
+# Blanked out: personal data, and bulky guild sections no handler reads.
+DROPPED_KEYS = {
+    "email", "phone", "avatar", "banner", "bio", "avatar_decoration_data",
+    "icon", "splash", "discovery_splash", "token", "session_id",
+    "presences", "voice_states", "stage_instances", "guild_scheduled_events",
+    "emojis", "stickers", "soundboard_sounds", "attachments", "embeds",
+}
+
+
+# Alternating between two disjoint alphabets means a token never has two equal
+# letters in a row, so normalizing it again (which collapses runs) keeps it intact.
+_EVEN_LETTERS = "abcdefghijklmnop"
+_ODD_LETTERS = "qrstuvwxyz"
+
+
+def content_token(content, normalize=None):
+    """Replaces message text with a letters-only hash of its normalized form.
+
+    Copies that normalize the same get the same token, and the token is as long
+    as the normalized text (up to 32 letters), so the bot's anti-spam stage
+    treats the replayed message the way it treated the original.
+    """
+    text = normalize(content) if normalize else content
+    if not text:
+        return ""
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    letters = []
+    for i in range(min(len(text), 32)):
+        nibble = (digest[i // 2] >> (4 * (i % 2))) & 0xF
+        letters.append(_EVEN_LETTERS[nibble] if i % 2 == 0 else _ODD_LETTERS[nibble % 10])
+    return "".join(letters)
+
+
+def sanitize(value, normalize=None):
+    """Strips personal data from a dispatch payload, keeping its shape."""
+    if isinstance(value, list):
+        return [sanitize(item, normalize) for item in value]
+    if not isinstance(value, dict):
+        return value
+
+    clean = {}
+    for key, item in value.items():
+        if key in DROPPED_KEYS:
+            # Blanked rather than removed; discord.py indexes some of these directly.
+            clean[key] = [] if isinstance(item, list) else None
+            continue
+        clean[key] = sanitize(item, normalize)
+
+    if "username" in clean and "id" in clean:
+        clean["username"] = f"user{str(clean['id'])[-4:]}"
+        clean["global_name"] = None
+    if "nick" in clean:
+        clean["nick"] = None
+    content = clean.get("content")
+    if isinstance(content, str) and not content.startswith(COMMAND_PREFIX):
+        clean["content"] = content_token(content, normalize)
+    return clean
+
+
+_STOP = object()
+
+
+class EventRecorder:
+    """Appends sanitized dispatch payloads to a gzipped JSON-lines file.
+
+    feed() only timestamps and enqueues the raw frame; parsing, sanitizing and
+    compressing happen on a writer thread, which also sync-flushes the gzip
+    stream every `flush_interval` seconds so a killed process loses at most
+    that much.
+    """
+
+    def __init__(self, path, normalize=None, flush_interval=1.0, max_pending=10000):
+        self.path = path
+        self.normalize = normalize
+        self.flush_interval = flush_interval
+        self.started = time.monotonic()
+        self.count = 0
+        self.dropped = 0
+        self.closed = False
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, name="event-recorder", daemon=True)
+        self.thread.start()
+
+    def feed(self, raw):
+        """Takes a raw gateway frame as given to on_socket_raw_receive."""
+        if self.closed or not isinstance(raw, str):
+            return
+        try:
+            self.queue.put_nowait((time.monotonic(), raw))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        header = {
+            "format": FORMAT_NAME,
+            "version": FORMAT_VERSION,
+            "recorded_at": datetime.now(timezone.utc).isoformat(),
+        }
+        with gzip.open(self.path, "wt", encoding="utf-8") as f:
+            f.write(json.dumps(header) + "\n")
+            f.flush()
+            last_flush = time.monotonic()
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    item = None
+                if item is _STOP:
+                    break
+                if item is not None:
+                    self._write(f, *item)
+                if time.monotonic() - last_flush >= self.flush_interval:
+                    f.flush()
+                    last_flush = time.monotonic()
+
+    def _write(self, f, received, raw):
+        payload = json.loads(raw)
+        if payload.get("op") != 0 or payload.get("t") not in RECORDED_EVENTS:
+            return
+        offset_ms = round((received - self.started) * 1000)
+        line = [offset_ms, payload["t"], sanitize(payload["d"], self.normalize)]
+        f.write(json.dumps(line, separators=(",", ":")) + "\n")
+        self.count += 1
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(_STOP)
+        self.thread.join()
+
+
+def load_recording(path):
+    """Returns the recorded [offset_ms, event, data] entries from `path`.
+
+    A recording cut short by a killed process still loads; everything up to
+    the last complete line is returned.
+    """
+    entries = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        if header.get("format") != FORMAT_NAME or header.get("version") != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} {FORMAT_NAME} recording")
+        try:
+            for line in f:
+                if line.strip():
+                    entries.append(json.loads(line))
+        except (EOFError, zlib.error, json.JSONDecodeError):
+            print(f"{path}: truncated recording, using the first {len(entries)} events", file=sys.stderr)
+    return entries
+
+
+def synthetic_joins(entries, count, per_second, start_ms):
+    """Builds a GUILD_MEMBER_ADD wave for the first guild in `entries`."""
+    guild_id = next((data["id"] for _, event, data in entries if event == "GUILD_CREATE"), None)
+    if guild_id is None:
+        raise ValueError("synthetic joins need a GUILD_CREATE in the recording")
+    joined_at = datetime.now(timezone.utc).isoformat()
+    joins = []
+    for i in range(count):
+        user_id = str((1 << 50) + i)
+        member = {
+            "guild_id": guild_id,
+            "user": {"id": user_id, "username": f"user{user_id[-4:]}", "discriminator": "0", "avatar": None},
+            "roles": [],
+            "joined_at": joined_at,
+            "deaf": False,
+            "mute": False,
+            "flags": 0,
+        }
+        joins.append([start_ms + round(i * 1000 / per_second), "GUILD_MEMBER_ADD", member])
+    return joins
+
+
+class FakeQuery:
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.action = "select"
+        self.values = None
+        self.filters = []
+
+    def select(self, *columns):
+        self.action = "select"
+        return self
+
+    def insert(self, values):
+        self.action = "insert"
+        self.values = values
+        return self
+
+    def update(self, values):
+        self.action = "update"
+        self.values = values
+        return self
+
+    def eq(self, column, value):
+        self.filters.append((column, value))
+        return self
+
+    def execute(self):
+        self.db.calls[f"{self.action} {self.table}"] += 1
+        rows = self.db.tables[self.table]
+        matched = [row for row in rows if all(row.get(c) == v for c, v in self.filters)]
+        if self.action == "insert":
+            rows.append(dict(self.values))
+            matched = [self.values]
+        elif self.action == "update":
+            for row in matched:
+                row.update(self.values)
+        return FakeResponse([dict(row) for row in matched])
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeSupabase:
+    """In-memory stand-in for the handful of Supabase calls main.py makes."""
+
+    def __init__(self):
+        self.tables = defaultdict(list)
+        self.tables["bot_stats"].append({"id": 1, "level": 1, "xp": 0, "full_xp": 50})
+        self.calls = Counter()
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+
+class FakeHTTP:
+    """Answers discord.py's HTTP routes locally and counts them."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.calls = Counter()
+        self.next_id = 1 << 40
+        self.guild_for_channel = {}
+
+    def _snowflake(self):
+        self.next_id += 1
+        return str(self.next_id)
+
+    def _bot_user(self):
+        user = self.bot.user
+        return {"id": str(user.id), "username": user.name, "discriminator": "0", "bot": True, "avatar": None}
+
+    def _member(self, user_id):
+        return {
+            "user": {"id": str(user_id), "username": f"user{str(user_id)[-4:]}", "discriminator": "0", "avatar": None},
+            "roles": [],
+            "joined_at": datetime.now(timezone.utc).isoformat(),
+            "deaf": False,
+            "mute": False,
+            "flags": 0,
+        }
+
+    def _message(self, channel_id, payload):
+        payload = payload or {}
+        return {
+            "id": self._snowflake(),
+            "channel_id": str(channel_id),
+            "author": self._bot_user(),
+            "content": payload.get("content") or "",
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": payload.get("embeds") or [],
+            "pinned": False,
+            "type": 0,
+        }
+
+    async def request(self, route, *, files=None, form=None, **kwargs):
+        self.calls[f"{route.method} {route.path}"] += 1
+        channel_id = getattr(route, "channel_id", None)
+
+        if route.method in ("POST", "PATCH") and route.path.startswith("/channels/{channel_id}/messages"):
+            return self._message(channel_id, kwargs.get("json"))
+        if route.method == "GET" and route.path == "/channels/{channel_id}":
+            guild_id = self.guild_for_channel.get(int(channel_id)) or next(iter(self.guild_for_channel.values()), 0)
+            return {
+                "id": str(channel_id),
+                "type": 0,
+                "guild_id": str(guild_id),
+                "name": "replay",
+                "position": 0,
+                "permission_overwrites": [],
+            }
+        if (route.method, route.path) in (("GET", "/guilds/{guild_id}/members/{member_id}"),
+                                          ("PATCH", "/guilds/{guild_id}/members/{user_id}")):
+            return self._member(int(route.url.rsplit("/", 1)[-1]))
+        return None
+
+
+class FakeGateway:
+    """Stands in for the websocket the bot never opens during a replay.
+
+    It always reports itself rate limited, so MemberConverter's gateway member
+    queries fall back to REST, where FakeHTTP answers and counts them.
+    """
+    open = False
+
+    def is_ratelimited(self):
+        return True
+
+
+class ReplayStats:
+    def __init__(self):
+        self.dispatch_lag = []
+        self.queue_delay = defaultdict(list)
+        self.handler_time = defaultdict(list)
+        self.errors = Counter()
+        self.commands = Counter()
+        self.command_errors = Counter()
+
+
+def _percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 3)
+
+    return {"count": len(ordered), "p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": pick(1.0)}
+
+
+def _instrument(bot, stats):
+    """Wraps event scheduling so every handler reports its queueing delay and runtime."""
+    original = bot._schedule_event
+    loop = asyncio.get_running_loop()
+
+    def _schedule_event(coro, event_name, *args, **kwargs):
+        queued = loop.time()
+
+        async def timed(*a, **kw):
+            started = loop.time()
+            stats.queue_delay[event_name].append(started - queued)
+            try:
+                await coro(*a, **kw)
+            except Exception:
+                stats.errors[event_name] += 1
+                raise
+            finally:
+                stats.handler_time[event_name].append(loop.time() - started)
+
+        return original(timed, event_name, *args, **kwargs)
+
+    bot._schedule_event = _schedule_event
+
+    async def count_command(ctx):
+        stats.commands[ctx.command.qualified_name] += 1
+
+    async def count_command_error(ctx, error):
+        name = ctx.command.qualified_name if ctx.command else "<unknown>"
+        stats.command_errors[name] += 1
+
+    bot.add_listener(count_command, "on_command")
+    bot.add_listener(count_command_error, "on_command_error")
+
+
+def _load_bot(db):
+    """Imports main.py with the fake database wired in before it connects."""
+    import supabase
+    supabase.create_client = lambda *args, **kwargs: db
+    os.environ.pop("RECORD_EVENTS_PATH", None)
+    os.environ["STATE_SNAPSHOT_PATH"] = ""
+    return importlib.import_module("main")
+
+
+async def replay(entries, speed):
+    db = FakeSupabase()
+    main = _load_bot(db)
+    bot = main.bot
+    discord = main.discord
+    stats = ReplayStats()
+
+    async with bot:
+        # What READY would have set up: without a user, get_context fails on every message.
+        bot._connection.user = discord.ClientUser(state=bot._connection, data={
+            "id": str(BOT_USER_ID), "username": "nene", "discriminator": "0", "avatar": None, "bot": True,
+        })
+        bot._connection.application_id = BOT_USER_ID
+        bot.ws = FakeGateway()
+        http = FakeHTTP(bot)
+        bot.http.request = http.request
+        _instrument(bot, stats)
+        # The raid window is 30s of recorded time, not wall-clock time.
+        main.refresh_threshold.change_interval(seconds=main.refresh_threshold.seconds / speed)
+        if not main.refresh_threshold.is_running():
+            main.refresh_threshold.start()
+
+        for _, event, data in entries:
+            if event == "GUILD_CREATE":
+                for channel in data.get("channels", []):
+                    http.guild_for_channel[int(channel["id"])] = int(data["id"])
+
+        parsers = bot._connection.parsers
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for offset_ms, event, data in entries:
+            target = started + offset_ms / 1000 / speed
+            delay = target - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            stats.dispatch_lag.append(max(0.0, loop.time() - target))
+            parsers[event](data)
+
+        # Let every handler spawned by the replay run to completion.
+        pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task() and t.get_name().startswith("discord.py")]
+        while pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            pending = [t for t in asyncio.all_tasks() if not t.done() and t.get_name().startswith("discord.py")]
+        elapsed = loop.time() - started
+
+        main.refresh_threshold.cancel()
+
+    handled = sum(len(samples) for samples in stats.handler_time.values())
+    return {
+        "events": len(entries),
+        "speed": speed,
+        "elapsed_s": round(elapsed, 3),
+        "handlers_per_s": round(handled / elapsed, 1) if elapsed else None,
+        "dispatch_lag": _percentiles(stats.dispatch_lag),
+        "queue_delay": {name: _percentiles(s) for name, s in stats.queue_delay.items()},
+        "handler_time": {name: _percentiles(s) for name, s in stats.handler_time.items()},
+        "handler_errors": dict(stats.errors),
+        "commands": dict(stats.commands),
+        "command_errors": dict(stats.command_errors),
+        "http_calls": dict(http.calls),
+        "http_calls_total": sum(http.calls.values()),
+        "db_calls": dict(db.calls),
+        "members_counted_for_raid": main.member_last30,
+        "raid_kicks": http.calls.get("DELETE /guilds/{guild_id}/members/{user_id}", 0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded gateway session against the bot.")
+    parser.add_argument("recording", help="file written with RECORD_EVENTS_PATH set")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed multiplier, 1 to 100")
+    parser.add_argument("--synthetic-joins", type=int, default=0, metavar="N",
+                        help="inject N member joins into the first recorded guild")
+    parser.add_argument("--join-rate", type=float, default=5.0, help="synthetic joins per recorded second")
+    parser.add_argument("--join-start", type=float, default=0.0, help="recorded second the join wave starts at")
+    args = parser.parse_args()
+
+    if not 1 <= args.speed <= 100:
+        parser.error("--speed must be between 1 and 100")
+    if args.join_rate <= 0:
+        parser.error("--join-rate must be positive")
+
+    entries = load_recording(args.recording)
+    if args.synthetic_joins:
+        entries += synthetic_joins(entries, args.synthetic_joins, args.join_rate, round(args.join_start * 1000))
+        # Stable sort keeps the GUILD_CREATE ahead of joins that share its offset.
+        entries.sort(key=lambda entry: entry[0])
+    report = asyncio.run(replay(entries, args.speed))
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
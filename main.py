@@ -3,7 +3,16 @@ import time
 import random
 import json
 import asyncio
-from datetime import date
+import atexit
+import copy
+import queue
+import logging
+import logging.handlers
+import re
+import signal
+import struct
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
 
 import discord
 from discord.ext import commands, tasks
@@ -21,9 +30,122 @@ ENABLE_HEALTH = os.getenv("ENABLE_HEALTH_SERVER", "0") == "1"
 PORT = int(os.getenv("PORT", 10000))
 WAKEUP_CHANNEL_ID = int(os.getenv("WAKEUP_CHANNEL_ID", 1451915364396171437))
 
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+LOG_ERROR_WINDOW = float(os.getenv("LOG_ERROR_WINDOW", 60))
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line."""
+    context_keys = ("guild", "user", "command", "latency_ms", "suppressed", "dropped")
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in self.context_keys:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class ErrorRateLimitFilter(logging.Filter):
+    """Lets one copy of a repeated error through per window and counts the rest.
+
+    Only attached to the `nene.db` logger, so a database outage can't flood the
+    log while unrelated errors and tracebacks always get through.
+    """
+
+    def __init__(self, window):
+        super().__init__()
+        self.window = window
+        self.last_emitted = {}
+        self.suppressed = {}
+
+    def filter(self, record):
+        if record.levelno < logging.ERROR:
+            return True
+        # Keyed on the template and the exception types, so a flood of the same
+        # failure collapses whatever its text, but a different failure doesn't.
+        key = (record.name, record.msg) + tuple(type(arg).__name__ for arg in record.args or ())
+        now = record.created
+        if now - self.last_emitted.get(key, float("-inf")) < self.window:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return False
+        self.last_emitted[key] = now
+        suppressed = self.suppressed.pop(key, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops records instead of blocking when the queue is full."""
+    dropped = 0
+    unreported = 0
+
+    def prepare(self, record):
+        # Interpolating the message is cheap and pins down mutable args now; the
+        # traceback, the expensive part, is left for the listener thread to format.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        if self.unreported:
+            record.dropped = self.unreported
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self.unreported += 1
+        else:
+            self.unreported = 0
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Blocks until the listener makes room, so stopping works with a full queue.
+        self.queue.put(self._sentinel)
+
+def setup_logging():
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    logging.getLogger("nene.db").addFilter(ErrorRateLimitFilter(LOG_ERROR_WINDOW))
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(queue_handler)
+
+    # The only thread that ever touches stdout; the event loop just enqueues.
+    listener = DrainingQueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener, queue_handler
+
+log_listener, log_queue_handler = setup_logging()
+log = logging.getLogger("nene")
+db_log = logging.getLogger("nene.db")
+
+def command_context(ctx, **extra):
+    """Builds the per-command `extra` dict attached to log records."""
+    context = {
+        "guild": ctx.guild.id if ctx.guild else None,
+        "user": ctx.author.id,
+        "command": ctx.command.qualified_name if ctx.command else None,
+    }
+    context.update(extra)
+    return context
+
 TOKEN = os.getenv("DISCORD_TOKEN") or os.getenv("KUSANAGI_APIKEY")
 if not TOKEN:
-    print("ERROR: No Discord token found. Set DISCORD_TOKEN environment variable.")
+    log.error("No Discord token found. Set DISCORD_TOKEN environment variable.")
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
@@ -32,7 +154,7 @@ if SUPABASE_URL and SUPABASE_KEY:
     try:
         supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
     except Exception as e:
-        print(f"Supabase init failed: {e}")
+        log.error("Supabase init failed: %s", e)
 
 server = Flask(__name__)
 
@@ -48,7 +170,12 @@ def health_check():
     except Exception:
         ready = False
     
-    return jsonify({"status": "ok", "bot_online": ready}), 200
+    return jsonify({
+        "status": "ok",
+        "bot_online": ready,
+        "member_cache": member_cache.stats(),
+        "log_records_dropped": log_queue_handler.dropped,
+    }), 200
 
 
 def _start_flask_in_thread():
@@ -56,12 +183,146 @@ def _start_flask_in_thread():
         server.run(host='0.0.0.0', port=PORT, use_reloader=False)
     t = Thread(target=_run, daemon=True)
     t.start()
-    print(f"Started health server thread on port {PORT}")
+    log.info("Started health server thread on port %s", PORT)
+
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", 2048))
+MEMBER_CACHE_TTL = float(os.getenv("MEMBER_CACHE_TTL", 600))
+# Opt-in: needs the privileged members intent enabled in the developer portal.
+LAZY_MEMBER_CHUNKING = os.getenv("LAZY_MEMBER_CHUNKING", "0") == "1"
 
 intents = discord.Intents.default()
 intents.message_content = True
+if LAZY_MEMBER_CHUNKING:
+    intents.members = True
+
+# Set to a file path to record sanitized gateway events for loadtest.py.
+RECORD_EVENTS_PATH = os.getenv("RECORD_EVENTS_PATH")
+
+bot = commands.Bot(
+    command_prefix="KN-",
+    intents=intents,
+    enable_debug_events=bool(RECORD_EVENTS_PATH),
+    chunk_guilds_at_startup=False,
+    # With chunking on, member_cache below is the only member cache, so it stays bounded.
+    member_cache_flags=discord.MemberCacheFlags.none() if LAZY_MEMBER_CHUNKING else discord.MemberCacheFlags.from_intents(intents),
+)
+
+class _MemberEntry:
+    __slots__ = ("member", "stored_at")
+
+    def __init__(self, member, stored_at):
+        self.member = member
+        self.stored_at = stored_at
+
+class MemberCache:
+    """LRU of resolved members keyed by (guild_id, user_id), with a TTL so roles don't go stale.
+
+    Member removals are only seen with the members intent (LAZY_MEMBER_CHUNKING);
+    otherwise a departed member lingers until the TTL runs out or a command
+    acting on them comes back 404.
+    """
+
+    def __init__(self, capacity, ttl):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.chunked_guilds = {}  # guild_id -> monotonic time of the last chunk
+        self.chunk_tasks = set()
+
+    def get(self, guild_id, user_id):
+        key = (guild_id, user_id)
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry.stored_at > self.ttl:
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry.member
+
+    def put(self, member):
+        key = (member.guild.id, member.id)
+        self.entries[key] = _MemberEntry(member, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, guild_id, user_id):
+        self.entries.pop((guild_id, user_id), None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "chunked_guilds": len(self.chunked_guilds),
+        }
+
+    def schedule_chunk(self, guild):
+        """Fetches the whole member list of `guild` in the background, at most once per TTL."""
+        if not LAZY_MEMBER_CHUNKING:
+            return
+        # Chunked entries expire with the TTL, so the guild is due again after it.
+        chunked_at = self.chunked_guilds.get(guild.id)
+        if chunked_at is not None and time.monotonic() - chunked_at <= self.ttl:
+            return
+        # Chunking a guild bigger than the cache would only churn it.
+        if (guild.member_count or 0) > self.capacity:
+            return
+        self.chunked_guilds[guild.id] = time.monotonic()
+        task = asyncio.create_task(self._chunk(guild))
+        self.chunk_tasks.add(task)
+        task.add_done_callback(self.chunk_tasks.discard)
+
+    async def _chunk(self, guild):
+        try:
+            members = await guild.chunk(cache=False)
+        except Exception:
+            log.exception("Member chunking failed for guild %s", guild.id)
+            self.chunked_guilds.pop(guild.id, None)
+            return
+        for member in members:
+            self.put(member)
+        log.info("Chunked %s members for guild %s", len(members), guild.id)
+
+member_cache = MemberCache(MEMBER_CACHE_SIZE, MEMBER_CACHE_TTL)
+
+MENTION_OR_ID = re.compile(r"<@!?([0-9]{15,20})>$|([0-9]{15,20})$")
+
+class CachedMember(commands.MemberConverter):
+    """MemberConverter that checks member_cache before going to the gateway or REST."""
+
+    async def convert(self, ctx, argument):
+        match = MENTION_OR_ID.match(argument)
+        if not (ctx.guild and match):
+            return await super().convert(ctx, argument)
+
+        user_id = int(match.group(1) or match.group(2))
+        # discord.py's own cache and the message's mentions cost nothing and are
+        # fresher than ours; member_cache only stands in for the network lookup.
+        member = ctx.guild.get_member(user_id) or discord.utils.get(ctx.message.mentions, id=user_id)
+        if isinstance(member, discord.Member):
+            return member
+
+        member = member_cache.get(ctx.guild.id, user_id)
+        if member is not None:
+            return member
+        member_cache.schedule_chunk(ctx.guild)
+
+        member = await super().convert(ctx, argument)
+        if isinstance(member, discord.Member):
+            member_cache.put(member)
+        return member
 
-bot = commands.Bot(command_prefix="KN-", intents=intents)
 wakeup_channel_id = 1451915364396171437
 
 TOKEN_KEY = os.getenv("KUSANAGI_APIKEY")
@@ -94,6 +355,7 @@ full_xp = 50
 
 member_last30 = 0 
 members_threshold = 30
+raid_window_started = time.time()
 
 def get_balance(user_id):
     try:
@@ -102,47 +364,47 @@ def get_balance(user_id):
             return response.data[0]['balance']
         return None
     except Exception as e:
-        print(f"Database Error: {e}")
+        db_log.error("Database Error: %s", e)
         return None
 
 def update_balance(user_id, new_amount):
     try:
         supabase.table('profiles').update({'balance': new_amount}).eq('user_id', user_id).execute()
     except Exception as e:
-        print(f"Database Error: {e}")
+        db_log.error("Database Error: %s", e)
 
 def create_account_db(user_id):
     try:
         supabase.table('profiles').insert({'user_id': user_id, 'balance': 10}).execute()
         return True
     except Exception as e:
-        print(f"Creation Error: {e}")
+        db_log.error("Creation Error: %s", e)
         return False
 
-def get_global_stats():
-    """Fetches level, xp, and full_xp from the database."""
+def get_global_stats(default=(1, 0, 50)):
+    """Fetches level, xp, and full_xp from the database, or `default` if it can't."""
     try:
         # We always fetch the row where ID is 1
         response = supabase.table('bot_stats').select('*').eq('id', 1).execute()
         if response.data:
             data = response.data[0]
             return data['level'], data['xp'], data['full_xp']
-        return 1, 0, 50 # Default if table is empty
+        return default # Default if table is empty
     except Exception as e:
-        print(f"DB Error (Get Stats): {e}")
-        return 1, 0, 50
+        db_log.error("DB Error (Get Stats): %s", e)
+        return default
 
 def update_global_stats(new_level, new_xp, new_full_xp):
     """Updates the bot's stats in the database."""
     try:
-        print(f"SAVING → level={new_level}, xp={new_xp}, full_xp={new_full_xp}")
+        log.debug("SAVING → level=%s, xp=%s, full_xp=%s", new_level, new_xp, new_full_xp)
         supabase.table('bot_stats').update({
             'level': new_level,
             'xp': new_xp,
             'full_xp': new_full_xp
         }).eq('id', 1).execute()
     except Exception as e:
-        print(f"DB Error (Update Stats): {e}")
+        db_log.error("DB Error (Update Stats): %s", e)
 
 def compute_if_full():
     global level, xp, full_xp
@@ -159,12 +421,144 @@ def cooldown_ready(last_time, cooldown):
 
 @tasks.loop(seconds=30)
 async def refresh_threshold():
-    global member_last30
+    global member_last30, raid_window_started
     member_last30 = 0
+    raid_window_started = time.time()
+
+@refresh_threshold.before_loop
+async def finish_current_raid_window():
+    # The loop resets as soon as it starts; let a window restored from a
+    # snapshot (or begun at boot) run its full length first.
+    remaining = raid_window_started + refresh_threshold.seconds - time.time()
+    if remaining > 0:
+        await asyncio.sleep(remaining)
+
+# Empty disables snapshots.
+STATE_SNAPSHOT_PATH = os.getenv("STATE_SNAPSHOT_PATH", "nene_state.bin")
+SNAPSHOT_MAX_AGE = float(os.getenv("SNAPSHOT_MAX_AGE", 3600))
+SNAPSHOT_MAGIC = b"KNSS"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sH")
+# magic, version, saved_at, level, xp, full_xp, member_last30, raid_window_started,
+# last_cuddle, last_nuzzle, last_kiss, last_hug, last_headpat, last_ily,
+# then the number of pending anti-spam unlocks
+SNAPSHOT_FORMAT = struct.Struct("<4sHdqqqid6dH")
+# channel_id, previous send_messages (-1 unset, 0 denied, 1 allowed), unlock_at
+SNAPSHOT_LOCKDOWN = struct.Struct("<qbd")
+SEND_MESSAGES_CODES = {None: -1, False: 0, True: 1}
+
+def write_snapshot():
+    """Saves runtime state so the next boot can skip the database."""
+    if not STATE_SNAPSHOT_PATH:
+        return
+    data = SNAPSHOT_FORMAT.pack(
+        SNAPSHOT_MAGIC, SNAPSHOT_VERSION, time.time(),
+        level, xp, full_xp, member_last30, raid_window_started,
+        last_cuddle, last_nuzzle, last_kiss, last_hug, last_headpat, last_ily,
+        len(bot_lockdowns),
+    )
+    for channel_id, (previous, unlock_at) in bot_lockdowns.items():
+        data += SNAPSHOT_LOCKDOWN.pack(channel_id, SEND_MESSAGES_CODES[previous], unlock_at)
+    tmp_path = STATE_SNAPSHOT_PATH + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, STATE_SNAPSHOT_PATH)
+    except OSError as e:
+        log.error("Snapshot write failed: %s", e)
+        return
+    log.info("Saved state snapshot to %s", STATE_SNAPSHOT_PATH)
+
+def restore_snapshot():
+    """Loads the shutdown snapshot into the globals; returns True if it was usable."""
+    global level, xp, full_xp, member_last30, raid_window_started
+    global last_cuddle, last_nuzzle, last_kiss, last_hug, last_headpat, last_ily
+
+    if not STATE_SNAPSHOT_PATH:
+        return False
+    try:
+        with open(STATE_SNAPSHOT_PATH, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return False
+    except OSError as e:
+        log.error("Snapshot read failed: %s", e)
+        return False
+
+    if len(data) < SNAPSHOT_HEADER.size or data[:4] != SNAPSHOT_MAGIC:
+        log.warning("Ignoring malformed snapshot %s", STATE_SNAPSHOT_PATH)
+        return False
+    _, version = SNAPSHOT_HEADER.unpack_from(data)
+    if version != SNAPSHOT_VERSION:
+        log.warning("Ignoring snapshot version %s (expected %s)", version, SNAPSHOT_VERSION)
+        return False
+    if len(data) < SNAPSHOT_FORMAT.size:
+        log.warning("Ignoring malformed snapshot %s", STATE_SNAPSHOT_PATH)
+        return False
+    _, _, saved_at, *state, lockdown_count = SNAPSHOT_FORMAT.unpack_from(data)
+    if len(data) != SNAPSHOT_FORMAT.size + lockdown_count * SNAPSHOT_LOCKDOWN.size:
+        log.warning("Ignoring malformed snapshot %s", STATE_SNAPSHOT_PATH)
+        return False
+
+    # Pending unlocks come back however old the snapshot is; otherwise a
+    # restart mid-lockdown would leave those channels locked for good.
+    codes_to_send_messages = {code: value for value, code in SEND_MESSAGES_CODES.items()}
+    for i in range(lockdown_count):
+        channel_id, code, unlock_at = SNAPSHOT_LOCKDOWN.unpack_from(
+            data, SNAPSHOT_FORMAT.size + i * SNAPSHOT_LOCKDOWN.size)
+        bot_lockdowns[channel_id] = (codes_to_send_messages[code], unlock_at)
+
+    age = time.time() - saved_at
+    if not 0 <= age <= SNAPSHOT_MAX_AGE:
+        log.info("Ignoring stale snapshot (%.0fs old)", age)
+        return False
+
+    (level, xp, full_xp, raid_count, window_started,
+     last_cuddle, last_nuzzle, last_kiss, last_hug, last_headpat, last_ily) = state
+    # The raid counter only means something inside the window it was counted in;
+    # finish_current_raid_window holds off the next reset until that window ends.
+    if time.time() - window_started < refresh_threshold.seconds:
+        member_last30 = raid_count
+        raid_window_started = window_started
+    log.info("Restored state snapshot (%.1fs old)", age)
+    return True
+
+async def reconcile_global_stats():
+    """Checks the snapshot's XP against the database, which stays the source of truth."""
+    global level, xp, full_xp
+    restored = (level, xp, full_xp)
+    stats = await asyncio.to_thread(get_global_stats, None)
+    if stats is None:
+        return
+    if (level, xp, full_xp) != restored:
+        # XP was earned (and saved) while we were waiting; that's newer than both.
+        return
+    if tuple(stats) != restored:
+        log.warning("Snapshot stats %s differ from database %s; using database", restored, tuple(stats))
+        level, xp, full_xp = stats
+
+def close_on_sigterm():
+  global close_task
+  log.info("Received SIGTERM, shutting down")
+  close_task = asyncio.create_task(bot.close())
+
+@bot.event
+async def setup_hook():
+  global reconcile_task
+  # Render and most hosts stop the bot with SIGTERM; route it through bot.close()
+  # so bot.run returns and the snapshot gets written.
+  try:
+      asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, close_on_sigterm)
+  except (NotImplementedError, RuntimeError):
+      log.warning("Can't handle SIGTERM on this platform; only KN-sleep will save a snapshot")
+  if stats_from_snapshot:
+      reconcile_task = asyncio.create_task(reconcile_global_stats())
+  for channel_id in bot_lockdowns:
+      schedule_lockdown_lift(channel_id)
     
 @bot.event
 async def on_ready():
-  print(f'We have logged in as {bot.user}')
+  log.info("We have logged in as %s", bot.user)
 
   if not refresh_threshold.is_running():
       refresh_threshold.start()
@@ -201,7 +595,268 @@ async def on_member_join(member):
       await member.kick(member)
   else:
       member_last30 += 1
+
+@bot.event
+async def on_member_remove(member):
+  member_cache.discard(member.guild.id, member.id)
+
+async def lock_channel(channel, reason=None):
+    """Stops @everyone from sending messages in `channel`; returns the setting it replaced."""
+    role = channel.guild.default_role
+    overwrite = channel.overwrites_for(role)
+    previous = overwrite.send_messages
+    overwrite.send_messages = False
+    await channel.set_permissions(role, overwrite=overwrite, reason=reason)
+    return previous
+
+ANTI_SPAM = os.getenv("ANTI_SPAM", "1") == "1"
+SPAM_BURST = int(os.getenv("SPAM_BURST", 8))             # messages a user can send back to back
+SPAM_RATE = float(os.getenv("SPAM_RATE", 0.5))           # messages per second the bucket refills at
+SPAM_HISTORY = int(os.getenv("SPAM_HISTORY", 8))         # recent messages remembered per user
+SPAM_DUPLICATES = int(os.getenv("SPAM_DUPLICATES", 4))   # same message this many times is a flood
+SPAM_WINDOW = float(os.getenv("SPAM_WINDOW", 30))        # seconds a repeat still counts as a repeat
+SPAM_TIMEOUT = int(os.getenv("SPAM_TIMEOUT", 300))       # seconds an offender is timed out for
+SPAM_CHANNEL_HISTORY = int(os.getenv("SPAM_CHANNEL_HISTORY", 32))
+SPAM_MIN_LENGTH = int(os.getenv("SPAM_MIN_LENGTH", 8))   # shorter normalized text ("hi", "lol") is never compared
+# Channel lockdown is opt-in: a busy channel can agree on the same thing legitimately.
+SPAM_LOCKDOWN = os.getenv("SPAM_LOCKDOWN", "0") == "1"
+SPAM_LOCKDOWN_USERS = int(os.getenv("SPAM_LOCKDOWN_USERS", 5)) # distinct users posting the same thing
+SPAM_LOCKDOWN_DURATION = float(os.getenv("SPAM_LOCKDOWN_DURATION", 300)) # seconds before the bot unlocks again
+SPAM_TRACKED = int(os.getenv("SPAM_TRACKED", 4096))      # users/channels kept before the oldest is forgotten
+
+NOISE = re.compile(r"[\W\d_]+")
+REPEATED_CHARS = re.compile(r"(.)\1+")
+
+def normalize_content(content):
+    """Reduces message text so trivially edited copies ("SPAM!!", "spam 2", "spaaam") are equal."""
+    return REPEATED_CHARS.sub(r"\1", NOISE.sub("", content[:512].lower()))
+
+def content_digest(content):
+    text = normalize_content(content)
+    return hash(text) if len(text) >= SPAM_MIN_LENGTH else None
+
+class _UserSpamState:
+    __slots__ = ("tokens", "updated", "digests", "times", "pos", "backoff_until")
+
+    def __init__(self, now):
+        self.tokens = float(SPAM_BURST)
+        self.updated = now
+        self.digests = [None] * SPAM_HISTORY
+        self.times = [0.0] * SPAM_HISTORY
+        self.pos = 0
+        self.backoff_until = 0.0
+
+class _ChannelSpamState:
+    __slots__ = ("digests", "users", "times", "pos", "locked_at")
+
+    def __init__(self):
+        self.digests = [None] * SPAM_CHANNEL_HISTORY
+        self.users = [0] * SPAM_CHANNEL_HISTORY
+        self.times = [0.0] * SPAM_CHANNEL_HISTORY
+        self.pos = 0
+        self.locked_at = None
+
+class SpamGuard:
+    """Token buckets plus fixed-size rings of recent message digests, per user and per channel."""
+
+    def __init__(self):
+        self.users = OrderedDict()
+        self.channels = OrderedDict()
+
+    def _state(self, table, key, factory):
+        state = table.get(key)
+        if state is None:
+            state = table[key] = factory()
+            if len(table) > SPAM_TRACKED:
+                table.popitem(last=False)
+        else:
+            table.move_to_end(key)
+        return state
+
+    def check_user(self, guild_id, user_id, digest, now):
+        """Returns why this user is flooding, or None."""
+        state = self._state(self.users, (guild_id, user_id), lambda: _UserSpamState(now))
+        if now < state.backoff_until:
+            return None
+
+        state.tokens = min(SPAM_BURST, state.tokens + (now - state.updated) * SPAM_RATE)
+        state.updated = now
+        if state.tokens < 1:
+            return "rate"
+        state.tokens -= 1
+
+        if digest is None:
+            return None
+        copies = 1
+        for seen, at in zip(state.digests, state.times):
+            if seen == digest and now - at <= SPAM_WINDOW:
+                copies += 1
+        state.digests[state.pos] = digest
+        state.times[state.pos] = now
+        state.pos = (state.pos + 1) % SPAM_HISTORY
+        return "duplicate" if copies >= SPAM_DUPLICATES else None
+
+    def check_channel(self, channel_id, user_id, digest, now):
+        """Returns True the first time a channel sees the same message from too many users."""
+        if digest is None:
+            return False
+        state = self._state(self.channels, channel_id, _ChannelSpamState)
+
+        senders = {user_id}
+        for seen, sender, at in zip(state.digests, state.users, state.times):
+            if seen == digest and now - at <= SPAM_WINDOW:
+                senders.add(sender)
+        state.digests[state.pos] = digest
+        state.users[state.pos] = user_id
+        state.times[state.pos] = now
+        state.pos = (state.pos + 1) % SPAM_CHANNEL_HISTORY
+
+        if len(senders) < SPAM_LOCKDOWN_USERS:
+            return False
+        if state.locked_at is not None and now - state.locked_at <= SPAM_WINDOW:
+            return False
+        state.locked_at = now
+        return True
+
+    def back_off(self, guild_id, user_id, until):
+        """Stops flagging a user until `until`, e.g. while (or after failing at) timing them out."""
+        state = self.users.get((guild_id, user_id))
+        if state is not None:
+            state.backoff_until = until
+
+    def forget(self, guild_id, user_id):
+        self.users.pop((guild_id, user_id), None)
+
+spam_guard = SpamGuard()
+
+if RECORD_EVENTS_PATH:
+    from loadtest import EventRecorder
+
+    # Recorded content is normalized like the live anti-spam stage sees it,
+    # so floods replay as floods.
+    event_recorder = EventRecorder(RECORD_EVENTS_PATH, normalize=normalize_content)
+    atexit.register(event_recorder.close)
+
+    @bot.event
+    async def on_socket_raw_receive(msg):
+        event_recorder.feed(msg)
+
+    log.info("Recording gateway events to %s", RECORD_EVENTS_PATH)
+
+async def punish_spammer(message, why):
+    member = message.author
+    context = {"guild": message.guild.id, "user": member.id}
+    # Back off first so the messages still in flight don't trigger a second attempt.
+    # If the timeout fails (missing permission, higher role) the back-off stays,
+    # so the same doomed call isn't retried every burst.
+    spam_guard.back_off(message.guild.id, member.id, time.monotonic() + SPAM_TIMEOUT)
+    try:
+        await member.timeout(timedelta(seconds=SPAM_TIMEOUT), reason=f"Anti-spam: {why}")
+    except (discord.Forbidden, discord.HTTPException) as e:
+        log.error("Anti-spam timeout failed: %s", e, extra=context)
+        return
+    spam_guard.forget(message.guild.id, member.id)
+    log.info("Timed out %s for spam (%s)", member, why, extra=context)
+    if why == "duplicate":
+        await message.channel.send(f"H-hey, {member.mention}, slow down! Take a little break, okay?")
+
+# Locks the anti-spam stage made itself: channel_id -> (previous send_messages, unlock_at).
+# KN-lock takes a channel out of here, so an admin's lock is never lifted by the bot.
+bot_lockdowns = {}
+lockdown_tasks = set()
+
+async def lockdown_flood(message):
+    channel = message.channel
+    try:
+        previous = await lock_channel(channel, reason="Anti-spam: message flood")
+    except (discord.Forbidden, discord.HTTPException) as e:
+        log.error("Anti-spam lockdown failed: %s", e, extra={"guild": message.guild.id})
+        return
+    log.warning("Locked channel %s after a message flood", channel.id, extra={"guild": message.guild.id})
+    await channel.send("Everyone's saying the same thing...I'm locking this channel for a bit.")
+
+    existing = bot_lockdowns.get(channel.id)
+    if existing is not None:
+        # Already ours: keep the setting from before the first lock and just extend it.
+        previous = existing[0]
+    bot_lockdowns[channel.id] = (previous, time.time() + SPAM_LOCKDOWN_DURATION)
+    if existing is None:
+        schedule_lockdown_lift(channel.id)
+
+def schedule_lockdown_lift(channel_id):
+    task = asyncio.create_task(lift_lockdown(channel_id))
+    lockdown_tasks.add(task)
+    task.add_done_callback(lockdown_tasks.discard)
+
+async def lift_lockdown(channel_id):
+    # Re-read the deadline after each sleep; a repeat flood may have pushed it back.
+    while channel_id in bot_lockdowns:
+        delay = bot_lockdowns[channel_id][1] - time.time()
+        if delay <= 0:
+            break
+        await asyncio.sleep(delay)
+    await bot.wait_until_ready()
+
+    lockdown = bot_lockdowns.pop(channel_id, None)
+    if lockdown is None:
+        return  # An admin took the channel over with KN-lock.
+    channel = bot.get_channel(channel_id)
+    if channel is None:
+        return
+    role = channel.guild.default_role
+    overwrite = channel.overwrites_for(role)
+    if overwrite.send_messages is not False:
+        return  # Someone already unlocked it by hand.
+    overwrite.send_messages = lockdown[0]
+    try:
+        await channel.set_permissions(role, overwrite=overwrite, reason="Anti-spam: lockdown over")
+    except (discord.Forbidden, discord.HTTPException) as e:
+        log.error("Anti-spam unlock failed: %s", e, extra={"guild": channel.guild.id})
+        return
+    log.info("Unlocked channel %s", channel.id, extra={"guild": channel.guild.id})
+
+@bot.event
+async def on_message(message):
+  member = message.author
+  if ANTI_SPAM and message.guild and not member.bot and isinstance(member, discord.Member) \
+          and not member.guild_permissions.manage_messages:
+      now = time.monotonic()
+      digest = content_digest(message.content)
+
+      if SPAM_LOCKDOWN and spam_guard.check_channel(message.channel.id, member.id, digest, now):
+          await lockdown_flood(message)
+
+      why = spam_guard.check_user(message.guild.id, member.id, digest, now)
+      if why:
+          await punish_spammer(message, why)
+          return
+
+  await bot.process_commands(message)
       
+@bot.event
+async def on_command(ctx):
+  ctx.started_at = time.perf_counter()
+
+@bot.event
+async def on_command_completion(ctx):
+  latency_ms = round((time.perf_counter() - ctx.started_at) * 1000, 2)
+  log.info("command completed", extra=command_context(ctx, latency_ms=latency_ms))
+
+@bot.event
+async def on_command_error(ctx, error):
+  started_at = getattr(ctx, "started_at", None)
+  latency_ms = round((time.perf_counter() - started_at) * 1000, 2) if started_at else None
+  context = command_context(ctx, latency_ms=latency_ms)
+  if isinstance(error, commands.CommandInvokeError):
+      if isinstance(error.original, discord.NotFound) and ctx.guild:
+          # A cached member the API no longer knows about has left; stop serving them.
+          for arg in ctx.args:
+              if isinstance(arg, discord.Member):
+                  member_cache.discard(ctx.guild.id, arg.id)
+      log.error("command failed", exc_info=error.original, extra=context)
+  else:
+      log.warning("command rejected: %s", error, extra=context)
+
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def sleep(ctx):
@@ -212,7 +867,7 @@ async def sleep(ctx):
   ]
   await ctx.send(random.choice(response_list))
 
-  print(f"Administrator {ctx.author} has put Nene to sleep.")
+  log.info("Administrator %s has put Nene to sleep.", ctx.author, extra=command_context(ctx))
 
   await bot.close()
 
@@ -266,7 +921,7 @@ async def nuzzle(ctx):
     await ctx.send(xp_level_up)
   
 @bot.command()
-async def kiss(ctx, member: discord.Member = None):
+async def kiss(ctx, member : CachedMember = None):
   global last_kiss, xp, level, full_xp
   xp_level_up = None
   try:
@@ -310,7 +965,7 @@ async def kiss(ctx, member: discord.Member = None):
       await ctx.send(f"Hah, kiss yourself, {ctx.author.mention}!")
 
 @bot.command()
-async def lick(ctx, member : discord.Member = None):
+async def lick(ctx, member : CachedMember = None):
   if member is None or member.id == bot.application_id:
     response_list = [
       f"Ah, what the hell?! *She pushes {ctx.author.mention} away from her as she brushed her arm against her skirt,* What's wrong with you?!",
@@ -366,7 +1021,7 @@ async def hug(ctx):
       await ctx.send(xp_level_up)
 
 @bot.command()
-async def motorboat(ctx, member : discord.Member = None):
+async def motorboat(ctx, member : CachedMember = None):
   try:
     if member is None or member.id == bot.application_id:
       response_list = [
@@ -408,7 +1063,7 @@ async def meow(ctx):
   await ctx.reply(random.choice(response_list))
       
 @bot.command()
-async def slap(ctx, member: discord.Member = None):
+async def slap(ctx, member : CachedMember = None):
   try:
       if member is None or member.id == bot.application_id:
           response_list = [
@@ -471,7 +1126,7 @@ async def ily(ctx):
     await ctx.reply(random.choice(response_list))
 
 @bot.command()
-async def birthday(ctx, member : discord.Member = None, days : int = None):
+async def birthday(ctx, member : CachedMember = None, days : int = None):
   try:
       if not member or member.id == bot.application_id:
           date_now = date.today()
@@ -621,7 +1276,7 @@ async def my_acc(ctx):
 
 
 @bot.command()
-async def bite(ctx, member : discord.Member = None):
+async def bite(ctx, member : CachedMember = None):
     if member is None or member.id == bot.application_id:
         response_list = [
             "Oww! *Pushes you away* What was that for?!",
@@ -645,7 +1300,7 @@ async def bite(ctx, member : discord.Member = None):
         await ctx.send(random.choice(response_list))
 
 @bot.command()
-async def pay(ctx, member : discord.Member = None, amount : int = 1):
+async def pay(ctx, member : CachedMember = None, amount : int = 1):
     if member is None:
         await ctx.reply("You need to mention someone to pay!")
         return
@@ -685,14 +1340,13 @@ async def lock(ctx, channel_to_lock : discord.TextChannel = None):
   else:
     await ctx.reply("I'm gonna try locking down this channel...")
 
-  overwrite = channel.overwrites_for(ctx.guild.default_role)
-  overwrite.send_messages = False
-  await channel.set_permissions(ctx.guild.default_role, overwrite=overwrite)
+  await lock_channel(channel)
+  bot_lockdowns.pop(channel.id, None)
   await ctx.reply(f"I've locked down channel {channel}...")
 
 @bot.command()
 @commands.has_permissions(kick_members=True)
-async def buttkick(ctx, member : discord.Member = None):
+async def buttkick(ctx, member : CachedMember = None):
   try:
     if member is None:
       await ctx.reply("You have to name a member, y'know?")
@@ -702,6 +1356,7 @@ async def buttkick(ctx, member : discord.Member = None):
       await ctx.reply("...I'm not doing that to myself!")
     else:
       await member.kick(reason=reason)
+      member_cache.discard(ctx.guild.id, member.id)
       await ctx.reply("Buttkicked them!")
   except NotFound:
     await ctx.reply(f"That member doesn't exist, {ctx.author.mention}")
@@ -710,7 +1365,7 @@ async def buttkick(ctx, member : discord.Member = None):
 
 @bot.command()
 @commands.has_permissions(ban_members=True)
-async def banish(ctx, member : discord.Member = None, reason : str = None, seconds_messages : int = 86400):
+async def banish(ctx, member : CachedMember = None, reason : str = None, seconds_messages : int = 86400):
   try:
     if member is None:
       await ctx.reply("...Ban who?")
@@ -720,6 +1375,7 @@ async def banish(ctx, member : discord.Member = None, reason : str = None, secon
       await ctx.reply("...I'm not doing that to myself?! *slap*")
     else:
       await member.ban(reason=reason, delete_message_seconds=seconds_messages)
+      member_cache.discard(ctx.guild.id, member.id)
       await ctx.reply("I've banned them now.")
   except NotFound:
     await ctx.reply(f"That member doesn't exist, {ctx.author.mention}")
@@ -730,7 +1386,7 @@ async def banish(ctx, member : discord.Member = None, reason : str = None, secon
 
 @bot.command()
 @commands.has_permissions(ban_members=True)
-async def awaken(ctx, member : discord.Member = None, reason : str = None):
+async def awaken(ctx, member : CachedMember = None, reason : str = None):
     try:
       if member is None:
         await ctx.reply("...Unban who?")
@@ -748,18 +1404,23 @@ async def awaken(ctx, member : discord.Member = None, reason : str = None):
     except HTTPException:
       await ctx.reply("Uhm...Something happened, and I don't know what...Try again?")
 
-level, xp, full_xp = get_global_stats()
-print(f"Loaded Stats: Level {level}, XP {xp}/{full_xp}")
+reconcile_task = None
+stats_from_snapshot = restore_snapshot()
+if not stats_from_snapshot:
+    level, xp, full_xp = get_global_stats()
+log.info("Loaded Stats: Level %s, XP %s/%s", level, xp, full_xp)
 
 if __name__ == '__main__':
     if ENABLE_HEALTH:
         _start_flask_in_thread()
-        print("Health endpoint enabled — remember to set ENABLE_HEALTH_SERVER=1 in Render and use an external pinger to hit health")
+        log.info("Health endpoint enabled — remember to set ENABLE_HEALTH_SERVER=1 in Render and use an external pinger to hit health")
 
     if not TOKEN:
-        print("Missing token. Exiting.")
+        log.error("Missing token. Exiting.")
     else:
         try:
-            bot.run(TOKEN)
-        except Exception as e:
-            print(f"Bot failed to start: {e}")
+            bot.run(TOKEN, log_handler=None)
+        except Exception:
+            log.exception("Bot failed to start")
+        finally:
+            write_snapshot()